@@ -14,20 +14,29 @@ subsequent cleanup is required.
 from __future__ import print_function
 
 import codecs
+import fcntl
 import functools
 import glob
+import hashlib
 import json
 import os
+import re
 import requests
 import shutil
 import signal
 import subprocess
 import tempfile
+import threading
 import time
 import traceback
+import yaml
+
+from multiprocessing.pool import ThreadPool
 
 from docker import Client
 from docker.auth import auth
+from docker.errors import APIError
+from docker.utils import parse_repository_tag
 
 logger = None
 # unique identifier for build job
@@ -65,6 +74,21 @@ MAX_LOG_SIZE = int(os.environ['MAX_LOG_SIZE'])
 
 LOGIN_EMAIL = "highland@docker.com"
 PUSH_ATTEMPT_COUNT = 5
+# number of test service images pulled at the same time
+PULL_CONCURRENCY = int(os.environ.get('PULL_CONCURRENCY', 4))
+
+# where the build context is checked out: auto, disk, tmpfs or overlay
+WORKSPACE_BACKEND = os.environ.get('WORKSPACE_BACKEND', 'auto')
+# size cap of a tmpfs workspace in MiB
+WORKSPACE_TMPFS_MAX_MB = int(os.environ.get('WORKSPACE_TMPFS_MAX_MB', 2048))
+# directory of cached checkouts used as overlay lower directories
+WORKSPACE_CACHE = os.environ.get('WORKSPACE_CACHE', '/src/.cache')
+# hours after which a cached checkout is cloned again
+WORKSPACE_CACHE_MAX_AGE = int(os.environ.get('WORKSPACE_CACHE_MAX_AGE', 24))
+WORKSPACE_PATH = os.path.join('/src', BUILD_CODE)
+OVERLAY_PATH = os.path.join('/src', '.overlay', BUILD_CODE)
+# ratio of checkout size (working tree and history) to repository size
+WORKSPACE_SIZE_FACTOR = 3
 GIT_PATH = '/usr/bin/git'
 
 # if the repository is a private github repository
@@ -80,6 +104,8 @@ os.environ["IMAGE_NAME"] = IMAGE_NAME
 # outputs from git to denote what failure occured
 ACCESS_RIGHTS_SUBSTR = 'Please make sure you have the correct access rights'
 NO_BRANCH_SUBSTR = 'not found in'
+NO_SPACE_SUBSTR = 'No space left on device'
+NO_SPACE_MESSAGE = 'the repository does not fit in the workspace'
 
 
 class BuildLogger(object):
@@ -92,6 +118,7 @@ class BuildLogger(object):
         self.logfile = logfile
         self.written_bytes = 0
         self.done = False
+        self.lock = threading.Lock()
 
     def __getattr__(self, attr_name):
         return functools.partial(self.log, attr_name)
@@ -112,9 +139,10 @@ class BuildLogger(object):
         message = message.encode("utf-8", 'ignore')
         if not message.endswith(end):
             message += end
-        if stage in self.logged_stages:
-            self.write_to_logfile(message)
-        print(message, end="")
+        with self.lock:
+            if stage in self.logged_stages:
+                self.write_to_logfile(message)
+            print(message, end="")
 
 
 class HighlandError(Exception):
@@ -220,7 +248,45 @@ def get_clone_commands():
                             SOURCE_TYPE)
 
 
+def get_update_commands():
+    """
+    Return a list of command parts suitable for Popen that will
+    update an existing checkout to the source of the build context
+    """
+    if SOURCE_TYPE == 'git':
+        branch = SOURCE_BRANCH or "master"
+        fetch_command = [GIT_PATH, 'fetch', 'origin', branch]
+        if not SOURCE_COMMIT:
+            fetch_command[2:2] = ['--depth', '1']
+        elif os.path.isfile(os.path.join('.git', 'shallow')):
+            # the commit may predate the history of a shallow checkout
+            fetch_command[2:2] = ['--unshallow']
+        return [
+            [GIT_PATH, 'remote', 'set-url', 'origin', SOURCE_URL],
+            fetch_command,
+            [GIT_PATH, 'checkout', '-f', '-B', branch,
+             SOURCE_COMMIT or 'FETCH_HEAD'],
+            [GIT_PATH, 'clean', '-ffdx'],
+            [GIT_PATH, 'submodule', 'update', '--init', '--recursive'],
+        ]
+
+    elif SOURCE_TYPE == 'hg':
+        return [
+            ['/usr/bin/hg', 'pull', '-r', SOURCE_BRANCH or "default",
+             SOURCE_URL],
+            ['/usr/bin/hg', 'update', '-C', SOURCE_BRANCH or "default"],
+            ['/usr/bin/hg', '--config', 'extensions.purge=', 'purge',
+             '--all'],
+        ]
+
+    else:
+        raise HighlandError("Invalid SCM type: %r must be git or hg" %
+                            SOURCE_TYPE)
+
+
 def convert_clone_error(clone_error):
+    if NO_SPACE_SUBSTR in clone_error:
+        return NO_SPACE_MESSAGE
     if ACCESS_RIGHTS_SUBSTR in clone_error:
         return (
             'please ensure the correct public key is added to the list of trusted '
@@ -233,14 +299,20 @@ def convert_clone_error(clone_error):
         'keys for this repository and the remote branch exists.')
 
 
-def clone():
+def clone(update=False):
     """
-    Clone the source of the build context and set it as the working directory
+    Clone the source of the build context into the working directory
+
+    :param update: update the checkout already in the working directory
+                   instead of cloning into an empty one
     """
     logger.clone("Starting to clone")
     if SSH_PRIVATE:
         write_private_key()
-    clone_commands = get_clone_commands()
+    if update:
+        clone_commands = get_update_commands()
+    else:
+        clone_commands = get_clone_commands()
     for clone_command in clone_commands:
         execute_command('clone', clone_command, convert_clone_error)
     if SOURCE_TYPE == 'git':
@@ -248,10 +320,269 @@ def clone():
         os.environ['GIT_MSG'] = get_output(['git', 'log', '--format=%B', '-n',
                                             '1', os.environ['GIT_SHA1']])
         os.environ['COMMIT_MSG'] = os.environ['GIT_MSG']
-    del os.environ['SOURCE_URL']
+    os.environ.pop('SOURCE_URL', None)
     logger.clone("Cloning done")
 
 
+def get_cache_key_path():
+    return os.path.join(WORKSPACE_CACHE,
+                        hashlib.sha1(SOURCE_URL).hexdigest())
+
+
+def get_cache_generations():
+    """
+    Return the creation times of the complete cached checkouts of the
+    source, oldest first. Each is a directory named after its creation time.
+    """
+    try:
+        names = os.listdir(get_cache_key_path())
+    except OSError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def get_cache_path():
+    """
+    Return the newest cached checkout of the source, or None
+    """
+    generations = get_cache_generations()
+    if not generations:
+        return None
+    return os.path.join(get_cache_key_path(), str(generations[-1]))
+
+
+def is_cache_fresh(cache_path):
+    created = int(os.path.basename(cache_path))
+    return time.time() - created < WORKSPACE_CACHE_MAX_AGE * 3600
+
+
+def get_free_disk_mb(path):
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize // (1024 * 1024)
+
+
+def get_used_disk_mb(path):
+    stat = os.statvfs(path)
+    return (stat.f_blocks - stat.f_bfree) * stat.f_frsize // (1024 * 1024)
+
+
+def get_available_memory_mb():
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def estimate_repo_size_mb():
+    """
+    Return the size of the source repository in MiB from the GitHub API,
+    or None if it cannot be estimated
+    """
+    match = re.match(
+        r'^(?:https://|git@)github\.com[/:]([^/]+)/(.+?)(?:\.git)?/?$',
+        SOURCE_URL)
+    if SOURCE_TYPE != 'git' or not match or SSH_PRIVATE:
+        return None
+    try:
+        response = requests.get(
+            'https://api.github.com/repos/{}/{}'.format(*match.groups()),
+            timeout=10)
+        if response.status_code == 200:
+            return response.json()['size'] // 1024
+    except Exception:
+        pass
+    return None
+
+
+def choose_workspace_backend():
+    """
+    Return the workspace backend to use, picking one by the estimated size of
+    the checkout when WORKSPACE_BACKEND is auto
+    """
+    if WORKSPACE_BACKEND not in ('auto', 'disk', 'tmpfs', 'overlay'):
+        raise HighlandError("Invalid workspace backend: %r must be auto, "
+                            "disk, tmpfs or overlay" % WORKSPACE_BACKEND)
+
+    if WORKSPACE_BACKEND != 'auto':
+        logger.info("Workspace backend set to {}".format(WORKSPACE_BACKEND))
+        return WORKSPACE_BACKEND
+    if get_cache_path():
+        logger.info("Found cached checkout of the repository")
+        return 'overlay'
+
+    repo_size = estimate_repo_size_mb()
+    free_disk = get_free_disk_mb('/src')
+    available_memory = get_available_memory_mb()
+    logger.info("Estimated repository size: {}, free disk: {} MiB, "
+                "available memory: {} MiB".format(
+                    'unknown' if repo_size is None else
+                    '{} MiB'.format(repo_size), free_disk, available_memory))
+    if repo_size is not None:
+        checkout_size = repo_size * WORKSPACE_SIZE_FACTOR
+        if checkout_size <= min(WORKSPACE_TMPFS_MAX_MB, available_memory // 2):
+            return 'tmpfs'
+        if checkout_size > free_disk:
+            logger.info("Checkout may not fit in the free disk space")
+    return 'disk'
+
+
+def remove_unused_caches():
+    """
+    Remove the cached checkouts superseded for longer than the cache max age,
+    which no build still running can use as its lowerdir, and leftovers of
+    interrupted clones. Must be called with the cache key locked.
+    """
+    key_path = get_cache_key_path()
+    generations = get_cache_generations()
+    with open('/proc/mounts') as mounts_file:
+        mounts = mounts_file.read()
+    for generation, successor in zip(generations, generations[1:]):
+        path = os.path.join(key_path, str(generation))
+        if (time.time() - successor > WORKSPACE_CACHE_MAX_AGE * 3600 and
+                'lowerdir={},'.format(path) not in mounts):
+            shutil.rmtree(path, ignore_errors=True)
+    for name in os.listdir(key_path):
+        if name.startswith('.tmp'):
+            shutil.rmtree(os.path.join(key_path, name), ignore_errors=True)
+
+
+def populate_cache():
+    """
+    Return the cached checkout of the source, cloning it when there is none
+    or the newest one is older than WORKSPACE_CACHE_MAX_AGE.
+
+    The clone is made in a temporary directory that is renamed into place
+    once complete, under a lock on the cache key, so that concurrent builds
+    never see or mount a partial checkout. Each refresh is a new directory
+    so that the checkouts mounted by running builds are left untouched.
+    """
+    cache_path = get_cache_path()
+    if cache_path and is_cache_fresh(cache_path):
+        return cache_path
+    key_path = get_cache_key_path()
+    if not os.path.isdir(key_path):
+        try:
+            os.makedirs(key_path)
+        except OSError:
+            if not os.path.isdir(key_path):
+                raise
+    with open(key_path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        cache_path = get_cache_path()
+        if cache_path and is_cache_fresh(cache_path):
+            return cache_path
+        if cache_path:
+            logger.info("Refreshing stale checkout cache...")
+        else:
+            logger.info("Populating checkout cache...")
+        remove_unused_caches()
+        clone_path = tempfile.mkdtemp(dir=key_path, prefix='.tmp')
+        os.chdir(clone_path)
+        try:
+            clone()
+            os.chdir('/src')
+            cache_path = os.path.join(key_path, str(max(
+                [int(time.time())] +
+                [generation + 1 for generation in get_cache_generations()])))
+            os.rename(clone_path, cache_path)
+        except Exception:
+            os.chdir('/src')
+            shutil.rmtree(clone_path)
+            raise
+    return cache_path
+
+
+def mount_workspace(backend, cache_path=None):
+    if backend == 'tmpfs':
+        execute_command('info', ['mount', '-t', 'tmpfs', '-o',
+                                 'size={}m'.format(WORKSPACE_TMPFS_MAX_MB),
+                                 'tmpfs', WORKSPACE_PATH],
+                        'mounting tmpfs workspace')
+
+    elif backend == 'overlay':
+        upper_path = os.path.join(OVERLAY_PATH, 'upper')
+        work_path = os.path.join(OVERLAY_PATH, 'work')
+        os.makedirs(upper_path)
+        os.makedirs(work_path)
+        execute_command('info', ['mount', '-t', 'overlay', '-o',
+                                 'lowerdir={},upperdir={},workdir={}'.format(
+                                     cache_path, upper_path, work_path),
+                                 'overlay', WORKSPACE_PATH],
+                        'mounting overlay workspace')
+
+
+def prepare_workspace():
+    """
+    Create the workspace directory on the chosen backend and return the
+    backend, falling back to disk if it cannot be mounted. Errors cloning
+    the checkout cache are raised as they are.
+    """
+    backend = choose_workspace_backend()
+    cache_path = None
+    if backend == 'overlay':
+        cache_path = populate_cache()
+    os.makedirs(WORKSPACE_PATH)
+    try:
+        mount_workspace(backend, cache_path)
+    except HighlandError as exc:
+        logger.info("Could not use {} workspace: {}".format(backend, exc))
+        backend = fall_back_to_disk(backend)
+    logger.info("Using {} workspace at {}".format(backend, WORKSPACE_PATH))
+    return backend
+
+
+def fall_back_to_disk(backend):
+    """
+    Tear down the workspace on backend and recreate it on disk
+    """
+    cleanup_workspace(backend)
+    os.makedirs(WORKSPACE_PATH)
+    return 'disk'
+
+
+def is_workspace_full(clone_error):
+    if NO_SPACE_MESSAGE in str(clone_error):
+        return True
+    try:
+        return get_free_disk_mb(WORKSPACE_PATH) < 16
+    except OSError:
+        return False
+
+
+def log_workspace_usage(backend):
+    """
+    Log the space used by a tmpfs workspace, or the free space left for a
+    workspace on disk, without walking the checkout
+    """
+    try:
+        if backend == 'tmpfs':
+            logger.info("Workspace size: {} MiB".format(
+                get_used_disk_mb(WORKSPACE_PATH)))
+        else:
+            logger.info("Free disk after checkout: {} MiB".format(
+                get_free_disk_mb(WORKSPACE_PATH)))
+    except OSError:
+        logger.info("Workspace size: unknown")
+
+
+def cleanup_workspace(backend):
+    os.chdir('/src')
+    if backend in ('tmpfs', 'overlay') and os.path.ismount(WORKSPACE_PATH):
+        subprocess.call(['umount', WORKSPACE_PATH])
+    if os.path.ismount(WORKSPACE_PATH):
+        logger.cleanup("Could not unmount workspace: {}".format(
+            WORKSPACE_PATH))
+        return
+    if os.path.isdir(OVERLAY_PATH):
+        shutil.rmtree(OVERLAY_PATH)
+    if os.path.isdir(WORKSPACE_PATH):
+        shutil.rmtree(WORKSPACE_PATH)
+
+
 def clean_path(path, ensure_start=True):
     """
     convert an absolute path to a relative one
@@ -371,6 +702,111 @@ def build(client, dockerfile_path):
         execute_command('build', 'hooks/post_build', 'post_build hook failed!')
 
 
+def get_compose_services(test_path):
+    """
+    Return the normalized service definitions of a docker-compose file
+    """
+    proc = subprocess.Popen(['docker-compose', '-f', test_path, 'config'],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        logger.test(output.decode("utf-8", "ignore"))
+        raise HighlandError('reading {} ({})'.format(test_path,
+                                                     proc.returncode))
+    config = yaml.safe_load(output) or {}
+    if 'version' in config:
+        return config.get('services') or {}
+    return config
+
+
+def get_compose_image(service_name, service):
+    """
+    Return the image name docker-compose uses for a service of the test project
+    """
+    if service.get('image'):
+        return service['image']
+    project = re.sub(r'[^a-z0-9]', '', BUILD_CODE.lower())
+    return '{}_{}'.format(project, service_name)
+
+
+def is_pinned_and_present(client, image):
+    """
+    Return True if image is referenced by digest and that digest is already
+    on the docker host, in which case pulling it cannot change anything
+    """
+    if '@' not in image:
+        return False
+    try:
+        client.inspect_image(image)
+    except APIError:
+        return False
+    return True
+
+
+def pull_test_images(client, images):
+    """
+    Pull the images used by the test services, skipping the ones that are
+    pinned to a digest already present and pulling the rest concurrently
+    """
+    to_pull = []
+    for image in sorted(images):
+        if is_pinned_and_present(client, image):
+            logger.test('Image {} is up to date, skipping pull'.format(image))
+        else:
+            to_pull.append(image)
+    if not to_pull:
+        return
+
+    logger.test('Pulling {} test image(s)...'.format(len(to_pull)))
+    pool = ThreadPool(min(PULL_CONCURRENCY, len(to_pull)))
+    try:
+        pool.map(lambda image: execute_command('test', ['docker', 'pull',
+                                                        image]),
+                 to_pull)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def build_test_images(client, test_path, services, built_images):
+    """
+    Build the services of a test file, reusing the images already built for
+    an identical build configuration by a previous test file
+
+    :param built_images: dict of build configuration to image ID, updated
+                         with the images built for this test file
+    """
+    services_to_build = []
+    new_images = {}
+    for service_name, service in sorted(services.items()):
+        if not service.get('build'):
+            continue
+        image = get_compose_image(service_name, service)
+        build_key = json.dumps(service['build'], sort_keys=True)
+        # only images of earlier test files exist yet, services of this file
+        # sharing a build configuration are all built by docker-compose
+        if build_key not in built_images:
+            new_images.setdefault(build_key, image)
+            services_to_build.append(service_name)
+            continue
+        # tag from the image ID, the name may since have been rebuilt from
+        # another build configuration
+        repository, tag = parse_repository_tag(image)
+        client.tag(built_images[build_key], repository, tag, force=True)
+        logger.test('Reusing image {} for service {}'.format(
+            built_images[build_key], service_name))
+
+    if services_to_build:
+        execute_command(
+            'test',
+            ['docker-compose', '-f', test_path, '-p', BUILD_CODE,
+             'build'] + services_to_build,
+            'building {}'.format(test_path))
+    for build_key, image in new_images.items():
+        built_images[build_key] = client.inspect_image(image)['Id']
+
+
 def test(client):
     logger.test("Starting Test")
 
@@ -382,14 +818,20 @@ def test(client):
         logger.test('Executing test hook...')
         execute_command('test', 'hooks/test', 'test hook failed!')
     else:
-        for test_path in glob.glob('*[.-]test.yml'):
+        test_paths = glob.glob('*[.-]test.yml')
+        test_services = dict((test_path, get_compose_services(test_path))
+                             for test_path in test_paths)
+        pull_test_images(client, set(
+            service['image']
+            for services in test_services.values()
+            for service in services.values()
+            if service.get('image') and not service.get('build')))
+
+        built_images = {}
+        for test_path in test_paths:
             logger.test("Starting Test in {}...".format(test_path))
-            execute_command('test',
-                            ['docker-compose', '-f', test_path, 'pull'])
-            execute_command(
-                'test',
-                ['docker-compose', '-f', test_path, '-p', BUILD_CODE, 'build'],
-                'building {}'.format(test_path))
+            build_test_images(client, test_path, test_services[test_path],
+                              built_images)
             execute_command('test', ['docker-compose', '-f', test_path, '-p',
                                      BUILD_CODE, 'up', '-d', 'sut'],
                             'starting "sut" service in  {}'.format(test_path))
@@ -480,9 +922,6 @@ def push(client):
 
 
 def cleanup(client, original_tags, original_containers):
-    if os.path.isdir(BUILD_CODE):
-        shutil.rmtree(BUILD_CODE)
-
     if original_containers is not None:
         current_containers = set(container.get('Id')
                                  for container in client.containers())
@@ -509,6 +948,7 @@ def run():
     client = None
     original_tags = None
     original_containers = None
+    workspace = None
     try:
         if BYON:
             logger.info("Building in User Node '{}'...".format(BYON))
@@ -516,9 +956,21 @@ def run():
             logger.info("Building in Docker Cloud's infrastructure...")
 
         os.chdir('/src')
-        os.makedirs(BUILD_CODE)
-        os.chdir(BUILD_CODE)
-        clone()
+        workspace = prepare_workspace()
+        os.chdir(WORKSPACE_PATH)
+        try:
+            clone(update=(workspace == 'overlay'))
+        except HighlandError as exc:
+            # the size estimate picking tmpfs may have been too low
+            if workspace != 'tmpfs' or not is_workspace_full(exc):
+                raise
+            logger.info("Repository does not fit in the {} MiB tmpfs "
+                        "workspace, cloning on disk".format(
+                            WORKSPACE_TMPFS_MAX_MB))
+            workspace = fall_back_to_disk(workspace)
+            os.chdir(WORKSPACE_PATH)
+            clone()
+        log_workspace_usage(workspace)
         build_path, dockerfile_path = print_dockerfile(BUILD_PATH,
                                                        DOCKERFILE_PATH)
         readme_path = get_readme(build_path)
@@ -561,6 +1013,13 @@ def run():
             logger.error('Unexpected error while cleaning up')
             logger.main('Unexpected error while cleaning up: {}\n{}'.format(
                 exc, traceback.format_exc()))
+        try:
+            if workspace:
+                cleanup_workspace(workspace)
+        except Exception as exc:
+            logger.error('Unexpected error while removing the workspace')
+            logger.main('Unexpected error while removing the workspace: '
+                        '{}\n{}'.format(exc, traceback.format_exc()))
 
 
 def interrupt_handler(signum, frame):
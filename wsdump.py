@@ -1,8 +1,17 @@
 #!/usr/bin/python
 
 import argparse
+import base64
+import binascii
+import bisect
 import code
+import collections
+import hashlib
+import json
+import random
 import six
+import socket
+import struct
 import sys
 import threading
 import time
@@ -23,8 +32,28 @@ def get_encoding():
 
 
 OPCODE_DATA = (websocket.ABNF.OPCODE_TEXT, websocket.ABNF.OPCODE_BINARY)
+OPCODE_REPLAYED = OPCODE_DATA + (websocket.ABNF.OPCODE_CONT,
+                                 websocket.ABNF.OPCODE_PING)
 ENCODING = get_encoding()
 
+# recording file layout: RECORD_MAGIC followed by one RECORD_HEADER
+# (arrival time in seconds since connect, opcode, fin bit, payload length)
+# and the raw payload for every received frame
+RECORD_MAGIC = b"WSDUMP\x00\x02"
+RECORD_HEADER = struct.Struct("!dBBI")
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+# prefix written before every payload with --framing length
+LENGTH_PREFIX = struct.Struct("!I")
+# number of leading payload bytes shown by --view hex
+HEX_PREVIEW = 32
+# upper bounds in milliseconds of the latency histogram buckets
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                   float("inf"))
+# number of latencies kept per report to compute percentiles from
+LATENCY_RESERVOIR = 100000
+# sends of a connection awaiting a reply before the oldest is unmatched
+MAX_PENDING_SENDS = 10000
+
 
 class VAction(argparse.Action):
     def __call__(self, parser, args, values, option_string=None):
@@ -60,6 +89,47 @@ def parse_args():
                         help="Send initial text")
     parser.add_argument("--timings", action="store_true",
                         help="Print timings in seconds")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record every received frame to FILE")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="send the frames recorded in FILE to ws_url "
+                        "instead of reading input")
+    parser.add_argument("--serve", action="store_true",
+                        help="with --replay, listen on the host and port of "
+                        "ws_url and serve the recorded frames to every "
+                        "client that connects")
+    parser.add_argument("--speed", default=1.0, type=float,
+                        help="replay speed factor, 0 replays as fast as "
+                        "possible. default: 1.0")
+    parser.add_argument("--load", default=0, type=int, metavar="N",
+                        help="open N concurrent connections and report "
+                        "throughput and latency instead of dumping frames")
+    parser.add_argument("--rate", default=0, type=float,
+                        help="with --load, messages per second each "
+                        "connection sends --text at, measuring round-trip "
+                        "latency. If 0 and no --replay, only inter-arrival "
+                        "latency of received frames is measured")
+    parser.add_argument("--duration", default=0, type=float,
+                        help="with --load, stop after this many seconds. "
+                        "default: run until Ctrl+C")
+    parser.add_argument("--interval", default=5, type=float,
+                        help="with --load or --view summary, seconds "
+                        "between reports. default: 5")
+    parser.add_argument("--json", action="store_true",
+                        help="with --load, print reports as JSON lines")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the payload of every data frame to FILE "
+                        "('-' for stdout) as raw bytes instead of printing "
+                        "messages")
+    parser.add_argument("--framing", choices=("none", "length"),
+                        default="none",
+                        help="with --output, 'length' writes a 4 byte big "
+                        "endian payload length before every payload")
+    parser.add_argument("--view", choices=("hex", "summary"),
+                        help="instead of printing messages, print the size "
+                        "and leading bytes of every frame (hex) or frame and "
+                        "byte rates every --interval seconds (summary) to "
+                        "stderr")
 
     return parser.parse_args()
 
@@ -97,11 +167,337 @@ class NonInteractive(RawInput):
     def read(self):
         return self.raw_input("")
 
-def main():
+class FrameRecorder():
+    def __init__(self, path, start_time):
+        self.fd = open(path, "wb")
+        self.fd.write(RECORD_MAGIC)
+        self.start_time = start_time
+        self.lock = threading.Lock()
+
+    def write(self, opcode, data, fin=1):
+        arrival = time.time() - self.start_time
+        if data is None:
+            data = b""
+        elif isinstance(data, six.text_type):
+            data = data.encode("utf-8")
+        with self.lock:
+            if self.fd.closed:
+                return
+            self.fd.write(RECORD_HEADER.pack(arrival, opcode, fin,
+                                             len(data)))
+            self.fd.write(data)
+
+    def close(self):
+        with self.lock:
+            self.fd.close()
+
+class FrameWriter():
+    def __init__(self, path, framing):
+        if path == "-":
+            self.fd = getattr(sys.stdout, "buffer", sys.stdout)
+        else:
+            self.fd = open(path, "wb")
+        self.framing = framing
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def write(self, opcode, data, fin=1):
+        if opcode not in OPCODE_DATA + (websocket.ABNF.OPCODE_CONT,):
+            return
+        with self.lock:
+            if self.closed:
+                return
+            if self.framing == "length":
+                self.fd.write(LENGTH_PREFIX.pack(len(data)))
+            self.fd.write(data)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.fd.flush()
+            if self.fd not in (sys.stdout,
+                               getattr(sys.stdout, "buffer", None)):
+                self.fd.close()
+
+class FrameView():
+    def __init__(self, view, interval):
+        self.view = view
+        self.interval = interval
+        self.start_time = self.interval_start = time.time()
+        self.frames = self.bytes = 0
+        self.total_frames = self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def write(self, opcode, data, fin=1):
+        size = len(data) if data else 0
+        with self.lock:
+            if self.view == "hex":
+                sys.stderr.write("%s %d bytes: %s\n" % (
+                    websocket.ABNF.OPCODE_MAP.get(opcode), size,
+                    binascii.hexlify(data[:HEX_PREVIEW] if data else b"")
+                    .decode("ascii")))
+            self.frames += 1
+            self.bytes += size
+
+    def tick(self):
+        """
+        Report if --interval elapsed since the last report, called
+        periodically so that a stalled stream is reported too
+        """
+        with self.lock:
+            if time.time() - self.interval_start >= self.interval:
+                self.report()
+
+    def report(self):
+        now = time.time()
+        self.total_frames += self.frames
+        self.total_bytes += self.bytes
+        if self.view == "summary":
+            elapsed = max(now - self.interval_start, 1e-9)
+            sys.stderr.write(
+                "%.1fs: %d frames, %d bytes, %.1f frames/s, %.1f KiB/s\n" % (
+                    now - self.start_time, self.frames, self.bytes,
+                    self.frames / elapsed, self.bytes / elapsed / 1024))
+        self.interval_start = now
+        self.frames = self.bytes = 0
+
+    def close(self):
+        with self.lock:
+            self.report()
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        sys.stderr.write(
+            "total: %d frames, %d bytes in %.1fs, %.1f KiB/s\n" % (
+                self.total_frames, self.total_bytes, elapsed,
+                self.total_bytes / elapsed / 1024))
+        sys.stderr.flush()
+
+def read_frames(path):
+    """
+    Yield (arrival, opcode, fin, data) for every frame recorded in path
+    """
+    with open(path, "rb") as fd:
+        if fd.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError("%s is not a wsdump recording" % path)
+        while True:
+            header = fd.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size:
+                raise ValueError("%s is truncated" % path)
+            arrival, opcode, fin, length = RECORD_HEADER.unpack(header)
+            data = fd.read(length)
+            if len(data) < length:
+                raise ValueError("%s is truncated" % path)
+            yield arrival, opcode, fin, data
+
+def play(path, speed, send):
+    """
+    Call send(opcode, data, fin) for every recorded data, continuation and
+    ping frame, keeping the original pace scaled by speed. Stops at the
+    first close frame.
+    """
     start_time = time.time()
-    args = parse_args()
-    if args.verbose > 1:
-        websocket.enableTrace(True)
+    for arrival, opcode, fin, data in read_frames(path):
+        if speed > 0:
+            delay = start_time + arrival / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if opcode == websocket.ABNF.OPCODE_CLOSE:
+            return
+        if opcode in OPCODE_REPLAYED:
+            send(opcode, data, fin)
+
+def accept_handshake(conn):
+    request = b""
+    while b"\r\n\r\n" not in request:
+        chunk = conn.recv(4096)
+        if not chunk:
+            raise websocket.WebSocketException("Handshake aborted")
+        request += chunk
+    key = None
+    for line in request.decode("latin-1").split("\r\n")[1:]:
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "sec-websocket-key":
+            key = value.strip()
+    if not key:
+        raise websocket.WebSocketException("Missing Sec-WebSocket-Key")
+    accept = base64.b64encode(
+        hashlib.sha1((key + WS_GUID).encode("latin-1")).digest())
+    conn.sendall(b"HTTP/1.1 101 Switching Protocols\r\n"
+                 b"Upgrade: websocket\r\n"
+                 b"Connection: Upgrade\r\n"
+                 b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+
+def wait_for_close(conn, timeout=2):
+    """
+    Read the frames of a client until its close frame arrives, the
+    connection is closed or timeout seconds pass
+    """
+    conn.settimeout(timeout)
+    buf = b""
+    while True:
+        try:
+            chunk = conn.recv(4096)
+        except socket.timeout:
+            return
+        if not chunk:
+            return
+        buf += chunk
+        while len(buf) >= 2:
+            opcode, length = six.indexbytes(buf, 0) & 0x0f, \
+                six.indexbytes(buf, 1) & 0x7f
+            offset = 2
+            if length == 126:
+                offset = 4
+            elif length == 127:
+                offset = 10
+            if len(buf) < offset:
+                break
+            if length == 126:
+                length = struct.unpack("!H", buf[2:4])[0]
+            elif length == 127:
+                length = struct.unpack("!Q", buf[2:10])[0]
+            if six.indexbytes(buf, 1) & 0x80:
+                offset += 4
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                return
+            if len(buf) < offset + length:
+                break
+            buf = buf[offset + length:]
+
+def serve(args):
+    url = urlparse(args.url)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((url.hostname or "", url.port or 80))
+    server.listen(128)
+    print("Serving %s on %s, press Ctrl+C to quit" % (args.replay, args.url))
+
+    def serve_client(conn, address):
+        def send(opcode, data, fin=1):
+            frame = websocket.ABNF(fin, 0, 0, 0, opcode, 0, data)
+            conn.sendall(frame.format())
+        try:
+            accept_handshake(conn)
+            play(args.replay, args.speed, send)
+            send(websocket.ABNF.OPCODE_CLOSE, struct.pack("!H", 1000))
+            wait_for_close(conn)
+        except (socket.error, websocket.WebSocketException) as e:
+            print("%s: %s" % (address[0], e))
+        finally:
+            conn.close()
+
+    while True:
+        try:
+            conn, address = server.accept()
+        except KeyboardInterrupt:
+            return
+        thread = threading.Thread(target=serve_client, args=(conn, address))
+        thread.daemon = True
+        thread.start()
+
+class LatencySamples():
+    """
+    Count, size, maximum and histogram of latencies, with a bounded uniform
+    sample of them to estimate percentiles from
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.count = 0
+        self.bytes = 0
+        self.unmatched = 0
+        self.max = None
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        self.reservoir = []
+
+    def add(self, latency, size):
+        self.count += 1
+        self.bytes += size
+        self.max = latency if self.max is None else max(self.max, latency)
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS,
+                                          latency * 1000)] += 1
+        if len(self.reservoir) < LATENCY_RESERVOIR:
+            self.reservoir.append(latency)
+        else:
+            index = random.randrange(self.count)
+            if index < LATENCY_RESERVOIR:
+                self.reservoir[index] = latency
+
+    def summary(self):
+        samples = sorted(self.reservoir)
+
+        def percentile(p):
+            if not samples:
+                return None
+            index = min(len(samples) - 1, int(len(samples) * p / 100.0))
+            return samples[index] * 1000
+
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        return collections.OrderedDict([
+            ("elapsed", elapsed),
+            ("messages", self.count),
+            ("bytes", self.bytes),
+            ("unmatched_sends", self.unmatched),
+            ("messages_per_sec", self.count / elapsed),
+            ("bytes_per_sec", self.bytes / elapsed),
+            ("p50_ms", percentile(50)),
+            ("p95_ms", percentile(95)),
+            ("p99_ms", percentile(99)),
+            ("max_ms", None if self.max is None else self.max * 1000),
+            ("histogram_ms", collections.OrderedDict(
+                (str(bound), count)
+                for bound, count in zip(LATENCY_BUCKETS, self.histogram))),
+        ])
+
+class LatencyStats():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = LatencySamples()
+        self.current = LatencySamples()
+
+    def add(self, latency, size):
+        with self.lock:
+            self.current.add(latency, size)
+            self.total.add(latency, size)
+
+    def unmatched(self):
+        with self.lock:
+            self.current.unmatched += 1
+            self.total.unmatched += 1
+
+    def interval(self):
+        """
+        Return the summary of the samples since the last call
+        """
+        with self.lock:
+            current, self.current = self.current, LatencySamples()
+        return current.summary()
+
+    def final(self):
+        with self.lock:
+            return self.total.summary()
+
+def print_report(kind, report, as_json):
+    if as_json:
+        report = collections.OrderedDict([("report", kind)] +
+                                         list(report.items()))
+        print(json.dumps(report))
+    else:
+        def ms(value):
+            return "-" if value is None else "%.2f" % value
+        print("%s: %d msgs in %.1fs, %.1f msg/s, %.1f KiB/s, "
+              "p50 %sms p95 %sms p99 %sms max %sms, %d unmatched sends" % (
+                  kind, report["messages"], report["elapsed"],
+                  report["messages_per_sec"], report["bytes_per_sec"] / 1024,
+                  ms(report["p50_ms"]), ms(report["p95_ms"]),
+                  ms(report["p99_ms"]), ms(report["max_ms"]),
+                  report["unmatched_sends"]))
+        if kind == "final":
+            for bound, count in report["histogram_ms"].items():
+                print("  <= %8s ms: %d" % (bound, count))
+    sys.stdout.flush()
+
+def connect(args):
     options = {}
     if (args.proxy):
         p = urlparse(args.proxy)
@@ -114,8 +510,125 @@ def main():
     opts = {}
     if (args.nocert):
         opts = { "cert_reqs": websocket.ssl.CERT_NONE, "check_hostname": False }
-    ws = websocket.create_connection(args.url, sslopt=opts, **options)
-    if args.raw:
+    return websocket.create_connection(args.url, sslopt=opts, **options)
+
+def load(args):
+    """
+    Open args.load connections and report throughput and latency. When the
+    connections send (--rate or --replay) the latency is the time from a
+    sent message to the next received one, otherwise the time between
+    received messages. Pings and continuation frames are not paired.
+    """
+    sending = bool(args.replay or args.rate > 0)
+    if args.rate > 0 and not args.text:
+        raise ValueError("--rate requires --text")
+    receivers = []
+
+    def receive(ws, sent):
+        last_arrival = None
+        while True:
+            try:
+                opcode, data = ws.recv_data()
+            except (socket.error, websocket.WebSocketException):
+                return
+            arrival = time.time()
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                return
+            if sending:
+                try:
+                    stats.add(arrival - sent.popleft(), len(data))
+                except IndexError:
+                    continue
+            elif last_arrival is not None:
+                stats.add(arrival - last_arrival, len(data))
+            last_arrival = arrival
+
+    def send(ws, sent):
+        def send_frame(opcode, data, fin=1):
+            if opcode in OPCODE_DATA:
+                if len(sent) >= MAX_PENDING_SENDS:
+                    try:
+                        sent.popleft()
+                        stats.unmatched()
+                    except IndexError:
+                        pass
+                sent.append(time.time())
+            ws.send_frame(websocket.ABNF.create_frame(data, opcode, fin))
+        try:
+            if args.replay:
+                play(args.replay, args.speed, send_frame)
+                return
+            next_send = time.time()
+            while True:
+                send_frame(websocket.ABNF.OPCODE_TEXT, args.text)
+                next_send += 1.0 / args.rate
+                delay = next_send - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        except (socket.error, websocket.WebSocketException):
+            return
+
+    # time only the traffic, not the connection setup
+    connections = [connect(args) for _ in range(args.load)]
+    stats = LatencyStats()
+    for ws in connections:
+        sent = collections.deque()
+        for target in [receive] + ([send] if sending else []):
+            thread = threading.Thread(target=target, args=(ws, sent))
+            thread.daemon = True
+            thread.start()
+            if target is receive:
+                receivers.append(thread)
+
+    deadline = time.time() + args.duration if args.duration else None
+    try:
+        while True:
+            wait = args.interval
+            if deadline:
+                wait = min(wait, deadline - time.time())
+            if wait > 0:
+                time.sleep(wait)
+            if deadline and time.time() >= deadline:
+                break
+            print_report("interval", stats.interval(), args.json)
+            if not any(thread.is_alive() for thread in receivers):
+                break
+    except KeyboardInterrupt:
+        pass
+    print_report("final", stats.final(), args.json)
+
+def main():
+    start_time = time.time()
+    args = parse_args()
+    if args.verbose > 1:
+        websocket.enableTrace(True)
+    if args.replay and args.serve:
+        serve(args)
+        return
+    if args.load:
+        load(args)
+        return
+    ws = connect(args)
+    connect_time = time.time()
+    if args.replay:
+        play(args.replay, args.speed,
+             lambda opcode, data, fin: ws.send_frame(
+                 websocket.ABNF.create_frame(data, opcode, fin)))
+        ws.close()
+        return
+    sinks = []
+    view = None
+    if args.record:
+        sinks.append(FrameRecorder(args.record, connect_time))
+    if args.output:
+        sinks.append(FrameWriter(args.output, args.framing))
+    if args.view:
+        view = FrameView(args.view, args.interval)
+        sinks.append(view)
+    streaming = bool(args.output or args.view)
+    # do not read stdin and run until the server closes the connection
+    capturing = bool(streaming or args.record)
+    if args.raw or streaming:
         console = NonInteractive()
     else:
         console = InteractiveConsole()
@@ -125,24 +638,33 @@ def main():
         try:
             frame = ws.recv_frame()
         except websocket.WebSocketException:
-            return (websocket.ABNF.OPCODE_CLOSE, None)
+            return (websocket.ABNF.OPCODE_CLOSE, None, 1)
         if not frame:
             raise websocket.WebSocketException("Not a valid frame %s" % frame)
         elif frame.opcode in OPCODE_DATA:
-            return (frame.opcode, frame.data)
+            return (frame.opcode, frame.data, frame.fin)
         elif frame.opcode == websocket.ABNF.OPCODE_CLOSE:
-            ws.send_close()
-            return (frame.opcode, None)
+            try:
+                ws.send_close()
+            except socket.error:
+                pass
+            return (frame.opcode, None, frame.fin)
         elif frame.opcode == websocket.ABNF.OPCODE_PING:
             ws.pong(frame.data)
-            return frame.opcode, frame.data
+            return frame.opcode, frame.data, frame.fin
 
-        return frame.opcode, frame.data
+        return frame.opcode, frame.data, frame.fin
 
 
     def recv_ws():
         while True:
-            opcode, data = recv()
+            opcode, data, fin = recv()
+            for sink in sinks:
+                sink.write(opcode, data, fin)
+            if streaming:
+                if opcode == websocket.ABNF.OPCODE_CLOSE:
+                    break
+                continue
             msg = None
             if six.PY3 and opcode == websocket.ABNF.OPCODE_TEXT and isinstance(data, bytes):
                 data = str(data, "utf-8")
@@ -167,15 +689,26 @@ def main():
     if args.text:
         ws.send(args.text)
 
-    while True:
-        try:
-            message = console.read()
-            ws.send(message)
-        except KeyboardInterrupt:
-            return
-        except EOFError:
-            time.sleep(args.eof_wait)
-            return
+    try:
+        while capturing and thread.is_alive():
+            try:
+                thread.join(min(1, args.interval))
+            except KeyboardInterrupt:
+                return
+            if view:
+                view.tick()
+        while not capturing:
+            try:
+                message = console.read()
+                ws.send(message)
+            except KeyboardInterrupt:
+                return
+            except EOFError:
+                time.sleep(args.eof_wait)
+                return
+    finally:
+        for sink in sinks:
+            sink.close()
 
 
 if __name__ == "__main__":